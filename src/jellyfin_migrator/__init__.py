@@ -1,8 +1,16 @@
 import importlib.metadata
-from .migrator import program_main
-
-__version__ = importlib.metadata.version("jellyfin-migrator")
 
 __all__ = [
     "__version__",
     "program_main",]
+
+
+# The migrator (and with it the config and TOML machinery) is only imported once it's actually
+# needed, so that e.g. the symlink fixer and the ID scanner don't have to load it.
+def __getattr__(name):
+    if name == "program_main":
+        from .migrator import program_main
+        return program_main
+    if name == "__version__":
+        return importlib.metadata.version("jellyfin-migrator")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
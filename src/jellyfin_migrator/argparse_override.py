@@ -1,11 +1,21 @@
 import argparse
+from functools import partial
+
+
+class OverrideAction(argparse.Action):
+    """ argparse action that stops parsing and calls a function whenever a particular
+    argument is encountered. The program is then exited """
+
+    def __init__(self, option_strings, dest, func, **kwargs):
+        super().__init__(option_strings, dest, **kwargs)
+        self.func = func
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        self.func(values)
+        parser.exit()
 
 
 def override(func):
     """ returns an argparse action that stops parsing and calls a function
     whenever a particular argument is encountered. The program is then exited """
-    class OverrideAction(argparse.Action):
-        def __call__(self, parser, namespace, values, option_string=None):
-            func(values)
-            parser.exit()
-    return OverrideAction
\ No newline at end of file
+    return partial(OverrideAction, func=func)
@@ -1,9 +1,20 @@
 import logging
+import pickle
+import sys
 from pathlib import Path
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
+from typing import Optional
 from fancy_dataclass import TOMLDataclass
 
 
+def _intern_replacements(replacements: dict) -> dict:
+    """Interns all string keys and values of a replacement dict (other values, like the
+    log_no_warnings flag, are kept as they are). Strings loaded from TOML files are str
+    subclasses which can't be interned, hence the conversion to str."""
+    return {sys.intern(str(k)): sys.intern(str(v)) if isinstance(v, str) else v
+            for k, v in replacements.items()}
+
+
 @dataclass
 class JellyfinPaths(TOMLDataclass, doc_as_comment=True):
     ffmpeg: str = field(metadata={
@@ -70,35 +81,100 @@ Read the README.md for more information on how to use this configuration.
     log_no_warnings: bool = field(default=False, metadata={
                                   'doc': 'If True, suppresses warnings about missing path replacements (read path_remap doc).'})
 
+    def __post_init__(self) -> None:
+        # The replacement dicts only depend on the fields above, which aren't changed after
+        # loading the config. They're built once on first use and reused afterwards.
+        self._path_cache: Optional[dict[str, str]] = None
+        self._fs_path_cache: Optional[dict[str, str]] = None
+        # Jellyfin subfolders on both systems, formatted once.
+        win_root, lin_root = f"{self.windows.root}", f"{self.linux.root}"
+        self._win_root, self._lin_root = win_root, lin_root
+        self._win_config, self._lin_config = f"{win_root}/config", f"{lin_root}/config"
+        self._win_cache, self._lin_cache = f"{win_root}/cache", f"{lin_root}/cache"
+        self._win_log, self._lin_log = f"{win_root}/log", f"{lin_root}/log"
+        self._lin_data = f"{lin_root}/data"
+        self._win_transcodes, self._lin_transcodes = f"{win_root}/transcodes", f"{lin_root}/transcodes"
+
+    def __getstate__(self) -> dict:
+        # Only pickle the actual configuration. Everything set up in __post_init__ is derived
+        # from it and is rebuilt when unpickling.
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.__post_init__()
+
     def _get_path_replacements(self) -> dict[str, str]:
+        if self._path_cache is not None:
+            return self._path_cache
         base_path_replacements = {
             "target_path_slash": "/",
-            f"{self.windows.root}/config": f"{self.linux.root}/config",
-            f"{self.windows.root}/cache": f"{self.linux.root}/cache",
-            f"{self.windows.root}/log": f"{self.linux.root}/log",
-            f"{self.windows.root}": f"{self.linux.root}/data",
-            f"{self.windows.root}/transcodes": f"{self.linux.root}/transcodes",
+            self._win_config: self._lin_config,
+            self._win_cache: self._lin_cache,
+            self._win_log: self._lin_log,
+            self._win_root: self._lin_data,
+            self._win_transcodes: self._lin_transcodes,
             f"{self.windows.ffmpeg}": f"{self.linux.ffmpeg}",
             "%MetadataPath%": "%MetadataPath%",
             "%AppDataPath%": "%AppDataPath%",
         }
-        path_replacements = self.path_map.copy()
-        path_replacements.update(base_path_replacements)
+        # The base entries take precedence over user entries with the same key.
+        path_replacements = _intern_replacements(
+            {**self.path_map, **base_path_replacements})
+        self._path_cache = path_replacements
         return path_replacements
 
     def _get_fs_path_replacements(self) -> dict[str, str]:
+        if self._fs_path_cache is not None:
+            return self._fs_path_cache
         base_replacements = {
             "log_no_warnings": self.log_no_warnings,
             "target_path_slash": "/",
-            f"{self.linux.root}": "/",
+            self._lin_root: "/",
             "%AppDataPath%": "/data/data",
             "%MetadataPath%": "/data/metadata",
         }
-        fs_path_replacements = self.path_remap.copy()
-        fs_path_replacements.update(base_replacements)
+        fs_path_replacements = _intern_replacements(
+            {**self.path_remap, **base_replacements})
+        self._fs_path_cache = fs_path_replacements
         return fs_path_replacements
 
 
+def load_cached_config(path: Path, cls: type):
+    """Loads a configuration of type cls from the TOML file at the specified path.
+
+    The parsed configuration is cached in a pickle file next to the TOML file
+    and reused as long as the TOML file's modification time and size don't change."""
+    path = Path(path)
+    stat = path.stat()
+    sidecar = path.with_suffix(path.suffix + '.pkl')
+    try:
+        with open(sidecar, 'rb') as f:
+            mtime_ns, size, config = pickle.load(f)
+        if mtime_ns == stat.st_mtime_ns and size == stat.st_size and isinstance(config, cls):
+            logging.debug(f"Using cached configuration from {sidecar}")
+            return config
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError,
+            ValueError, TypeError) as e:
+        # Missing, outdated or unreadable cache, parse the TOML file instead.
+        logging.debug(f"Could not use configuration cache {sidecar}: {e}")
+    with open(path) as f:
+        config = cls.from_toml(f)
+    try:
+        with open(sidecar, 'wb') as f:
+            pickle.dump((stat.st_mtime_ns, stat.st_size, config), f)
+    except OSError as e:
+        logging.debug(f"Could not write configuration cache {sidecar}: {e}")
+    return config
+
+
+def load_config(path: Path) -> MigrationConfig:
+    """Loads the migration configuration from the TOML file at the specified path.
+
+    See load_cached_config."""
+    return load_cached_config(path, MigrationConfig)
+
+
 def generate_default(path: Path) -> None:
     """Generates a default configuration file at the specified path."""
     wincfg = JellyfinPaths(
@@ -124,32 +200,11 @@ def generate_default(path: Path) -> None:
     )
     if path.exists():
         logging.error(f"Configuration file already exists at {path}.")
-    with open(path, 'w') as f:
+        return
+    with path.open('w', encoding='utf-8', buffering=1 << 16) as f:
         config.to_toml(f)
     logging.info(f"Default configuration written to {path}")
 
 
 if __name__ == '__main__':
-    wincfg = JellyfinPaths(
-        ffmpeg="C:/Program Files/ffmpeg/bin/ffmpeg.exe",
-        root="C:/ProgramData/Jellyfin"
-    )
-    lincfg = JellyfinPaths(
-        ffmpeg="/usr/lib/jellyfin-ffmpeg/ffmpeg",
-        root="/home/jellyfin/.jellyfin/Jellyfin"
-    )
-    config = MigrationConfig(
-        windows=wincfg,
-        linux=lincfg,
-        path_map={
-            "E:/Videos": "/home/jellyfin/Videos",
-            "E:/Music": "/home/jellyfin/Music",
-            "F:/Pictures": "/home/jellyfin/Pictures",
-        },
-        path_remap={
-
-        },
-        log_no_warnings=False,
-    )
-    with open('migration_config.toml', 'w') as f:
-        config.to_toml(f)
+    generate_default(Path('migration_config.toml'))
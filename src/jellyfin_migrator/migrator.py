@@ -15,26 +15,43 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-from functools import partial
-import math
+from collections import ChainMap
+from fnmatch import translate
+from functools import lru_cache, partial, wraps
+from itertools import chain, islice
 import pathlib
+import re
 from pprint import pformat
 import sqlite3
 import json
 import hashlib
 from typing import List, Optional, Tuple
-import xml.etree.ElementTree as ET
+try:
+    # lxml is quite a bit faster than the standard library's ElementTree but it's optional.
+    from lxml import etree as ET
+    HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAVE_LXML = False
+try:
+    # Same for orjson and json.
+    import orjson
+except ImportError:
+    orjson = None
 from pathlib import Path
-from shutil import copy
+from shutil import copy2, copyfile
 from tqdm import tqdm
 import logging
 
 from .argparse_override import override
 from .id_scanner import *
 from .config import *
+import calendar
 import datetime
 from string import ascii_letters
 import os
+import stat
+import time
 from multiprocessing.pool import Pool
 
 log_formatter = logging.Formatter(
@@ -85,12 +102,21 @@ class DisableLogger():
         logging.disable(logging.NOTSET)
 
 
-def partition(obj: list, num: int = 2000):
-    if len(obj) == 0 or num == 0:
-        return obj
-    k, m = divmod(len(obj), num)
-    for i in range(k):
-        yield obj[i*num+min(num, m):(i+1)*num+min(num, m)]
+# Number of rows fetched at once by fetch_rows.
+FETCH_BATCH_SIZE = 10000
+
+
+# Yields the rows of an executed query, fetching FETCH_BATCH_SIZE rows at a time instead of
+# reading all of them into a list first.
+def fetch_rows(cursor: sqlite3.Cursor):
+    while batch := cursor.fetchmany(FETCH_BATCH_SIZE):
+        yield from batch
+
+
+# Splits obj into lists of num items each (the last one may be shorter).
+def partition(obj, num: int = 2000):
+    it = iter(obj)
+    return iter(lambda: list(islice(it, num)), [])
 
 
 # Since library.db will be needed throughout the process, its location is stored
@@ -103,7 +129,225 @@ library_db_source_path = Path()
 ids = dict()
 
 
-# Recursively replace all paths in "d" which can be
+# Matches the names that are written as they are in json strings and xml files, see PathMatcher.
+SAFE_NAME_RE = re.compile(r"[A-Za-z0-9 _.%-]+")
+
+
+# Finds the first entry of a path replacement dict that a path is relative to. This is
+# equivalent to trying Path(path).is_relative_to(src) for every src in the order of the dict,
+# but all the sources are compiled into a single regex (one alternative per source, tried in
+# the same order), so a path is checked against all of them in one go.
+class PathMatcher():
+    # Entries of the replacement dicts that aren't paths.
+    special_keys = ("target_path_slash", "log_no_warnings")
+
+    def __init__(self, to_replace: dict):
+        # Path() accepts both / and \ on windows and compares case-insensitively there.
+        if os.name == "nt":
+            sep, flags = r"[\\/]", re.IGNORECASE
+        else:
+            sep, flags = "/", 0
+        self.slash = to_replace.get("target_path_slash", "/")
+        self.entries = []
+        patterns = []
+        # The last part of each source, which occurs literally in all matching paths. None if
+        # that's not guaranteed for every source (see may_match).
+        names = []
+        for src, dst in to_replace.items():
+            if src in self.special_keys or not isinstance(dst, (str, pathlib.PurePath)):
+                continue
+            # Bare IDs (f. ex. of the ID path pass) are relative paths, which no rooted path
+            # can be relative to. There can be lots of them, so they're left out of the regex.
+            if ID_CHARS.issuperset(src):
+                continue
+            parts = Path(src).parts
+            if not parts:
+                continue
+            anchor = Path(src).anchor
+            if anchor == "/" and os.name != "nt":
+                # Exactly two leading slashes are a different root for Path().
+                pattern = "/(?!/(?:[^/]|$))/*"
+            elif anchor == "//" and os.name != "nt":
+                pattern = "//(?!/)"
+            elif anchor:
+                pattern = re.escape(anchor.replace("\\", "/")).replace("/", sep) + sep + "*"
+            else:
+                pattern = ""
+            if anchor:
+                parts = parts[1:]
+            if parts:
+                pattern += (sep + "+").join(re.escape(part) for part in parts)
+                # Only match entire path components.
+                pattern += f"(?={sep}|$)"
+            # Entries that map a path onto itself (like %MetadataPath%) don't change anything, so
+            # texts containing only those paths can be skipped, too.
+            if names is not None and str(src) != str(dst):
+                # The name must not look any different when escaped in a json string or xml file.
+                # Jellyfin's json serializer escapes quite a few characters (f. ex. + and `), so
+                # only names made of characters that are never escaped are searched for.
+                if parts and SAFE_NAME_RE.fullmatch(parts[-1]):
+                    names.append(re.escape(parts[-1]))
+                else:
+                    logging.debug(f"Texts can't be skipped, the name of {src} may be escaped in them")
+                    names = None
+            patterns.append(f"({pattern})")
+            # The destination is converted to the target format once, here.
+            dst_posix = Path(dst).as_posix()
+            self.entries.append((src, dst, dst_posix, dst_posix.replace("/", self.slash),
+                                 "" if dst_posix.endswith("/") else self.slash))
+        self.regex = re.compile("|".join(patterns), flags) if patterns else None
+        self.names = re.compile("|".join(names), flags) if names else None
+        self.names_bytes = re.compile("|".join(names).encode(), flags) if names else None
+        self.names_complete = names is not None
+
+    # Checks whether a text (f. ex. a json string or the ASCII compatible contents of a file)
+    # may contain any path that matches. Much cheaper than looking at every single string
+    # within the text.
+    def may_match(self, text) -> bool:
+        if not self.names_complete:
+            return True
+        names = self.names_bytes if isinstance(text, bytes) else self.names
+        return names is not None and names.search(text) is not None
+
+    # Returns the entry the path is relative to and the end of the matched prefix, or None.
+    # Each entry consists of src, dst, dst as posix string, dst with target_path_slash, and
+    # the slash to put between dst and the rest of the path.
+    def match(self, path: str):
+        if self.regex is None:
+            return None
+        m = self.regex.match(path)
+        if m is None:
+            return None
+        # Each alternative has exactly one group, so the group index identifies the entry.
+        return self.entries[m.lastindex - 1], m.end()
+
+    # Returns the path with its root replaced according to the dict, or None if no entry matches.
+    def apply(self, path):
+        path = str(path)
+        result = self.match(path)
+        if result is None:
+            return None
+        (src, dst, dst_posix, dst_out, dst_slash), end = result
+        rest = path[end:]
+        if os.name == "nt":
+            rest = rest.replace("\\", "/")
+        rest = rest.lstrip("/")
+        # I guess 99% of the users won't migrate _to_ windows but the script could generate
+        # \ paths anyways.
+        # If the remainder of the path is already normalized, the new path can simply be glued
+        # together. Otherwise let pathlib sort out the duplicate slashes, "." parts, etc.
+        if dst_posix != "." and not rest.endswith("/") and "//" not in rest and "/./" not in f"/{rest}/":
+            if not rest:
+                return dst_out
+            if self.slash != "/":
+                rest = rest.replace("/", self.slash)
+            return dst_out + dst_slash + rest
+        try:
+            p = dst / Path(path).relative_to(src)
+        except ValueError:
+            return None
+        # p.as_posix() makes sure that we always get a string with "/". Otherwise, on windows,
+        # str(p) would automatically return "\" paths.
+        return p.as_posix().replace("/", self.slash)
+
+
+# Maximum number of replacement dicts whose PathMatchers are kept by get_path_matcher.
+PATH_MATCHER_CACHE_SIZE = 8
+# PathMatchers of the most recently used replacement dicts, by id. The dict itself is stored
+# along with the matcher, which keeps it alive and hence its id from being reused by another
+# dict as long as it's in here.
+path_matchers = dict()
+
+
+def get_path_matcher(to_replace: dict) -> PathMatcher:
+    entry = path_matchers.pop(id(to_replace), None)
+    if entry is None or entry[0] is not to_replace:
+        entry = (to_replace, PathMatcher(to_replace))
+        if len(path_matchers) >= PATH_MATCHER_CACHE_SIZE:
+            # Forget the least recently used one.
+            del path_matchers[next(iter(path_matchers))]
+    # (Re)insert the entry, the dict is ordered from least to most recently used.
+    path_matchers[id(to_replace)] = entry
+    return entry[1]
+
+
+# Maximum number of results kept per replacement dict and leaf function by cache_leaves.
+LEAF_CACHE_SIZE = 1 << 16
+# Maximum number of replacement dicts (and leaf functions) with a cache at the same time.
+LEAF_CACHE_COUNT = 8
+# Caches of cache_leaves by leaf function and id of the replacement dict. As with
+# path_matchers, the dict is stored along with the cache and only the most recently used
+# ones are kept.
+leaf_caches = dict()
+
+
+# Decorator for the functions replacing a single leaf. Many strings occur over and over again
+# (f. ex. all the files within the same folder share most of their path), hence the results
+# for strings and path objects are remembered and reused as long as the same replacement dict
+# is used.
+# Note that a replacement dict must not be modified once it has been used.
+def cache_leaves(replace_leaf):
+    @wraps(replace_leaf)
+    def wrapper(d, to_replace: dict):
+        if type(d) is not str and not isinstance(d, pathlib.PurePath):
+            return replace_leaf(d, to_replace)
+        key = (replace_leaf, id(to_replace))
+        entry = leaf_caches.get(key)
+        if entry is None or entry[0] is not to_replace:
+            entry = (to_replace, dict())
+            leaf_caches.pop(key, None)
+            if len(leaf_caches) >= LEAF_CACHE_COUNT:
+                # Forget the least recently created one.
+                del leaf_caches[next(iter(leaf_caches))]
+            leaf_caches[key] = entry
+        cache = entry[1]
+        result = cache.get(d)
+        if result is None:
+            if len(cache) >= LEAF_CACHE_SIZE:
+                cache.clear()
+            result = replace_leaf(d, to_replace)
+            cache[d] = result
+        return result
+    return wrapper
+
+
+# Forgets all the cached PathMatchers and leaf replacements.
+def clear_replacer_caches():
+    path_matchers.clear()
+    leaf_caches.clear()
+
+
+# Characters that can occur in the string formats of the IDs.
+ID_CHARS = frozenset("0123456789abcdef-")
+# Matches the (longest possible) runs of ID_CHARS.
+ID_TOKEN_RE = re.compile(r"[0-9a-f-]+")
+
+
+# Walks through "d" and replaces all the "leaves" (anything that's not a dict or a list)
+# with replace_leaf(leaf, to_replace). Nested structures are processed with an explicit stack
+# of containers instead of recursion, which is faster and doesn't hit the recursion limit for
+# deeply nested data. Dicts and lists are modified in place.
+# There's no progress bar in here; the callers show the progress per row or file.
+# Returns the (un)modified object as well as how many items have been modified or ignored.
+def replace_nested(d, to_replace: dict, replace_leaf):
+    if type(d) is not dict and type(d) is not list:
+        return replace_leaf(d, to_replace)
+    modified, ignored = 0, 0
+    stack = [d]
+    while stack:
+        container = stack.pop()
+        items = container.items() if type(container) is dict else enumerate(container)
+        for k, v in items:
+            if type(v) is dict or type(v) is list:
+                stack.append(v)
+            else:
+                container[k], mo, ig = replace_leaf(v, to_replace)
+                modified += mo
+                ignored += ig
+    return d, modified, ignored
+
+
+# Replace all paths in "d" which can be
 #  * a path object
 #  * a path string
 #  * a dictionary (only values are checked, no keys).
@@ -111,21 +355,22 @@ ids = dict()
 #  * any nested structure of the above.
 #  * anything else is returned unmodified.
 # Returns the (un)modified object as well as how many items have been modified or ignored.
-def recursive_root_path_replacer(d, to_replace: dict, position: int = 0):
+def recursive_root_path_replacer(d, to_replace: dict):
+    return replace_nested(d, to_replace, replace_root_path)
+
+
+# Replaces the root of a single path (string or path object) according to to_replace.
+# Anything else is returned unmodified. See recursive_root_path_replacer.
+@cache_leaves
+def replace_root_path(d, to_replace: dict):
     modified, ignored = 0, 0
-    if type(d) is dict:
-        for k, v in d.items():
-            d[k], mo, ig = recursive_root_path_replacer(
-                v, to_replace, position=position+1)
-            modified += mo
-            ignored += ig
-    elif type(d) is list:
-        for i, e in enumerate(d):
-            d[i], mo, ig = recursive_root_path_replacer(
-                e, to_replace, position=position+1)
-            modified += mo
-            ignored += ig
-    elif type(d) is str or isinstance(d, pathlib.PurePath):
+    if type(d) is str or isinstance(d, pathlib.PurePath):
+        # This filters out all the "garbage" paths that actually were no paths to begin with
+        # and of course all the paths that are actually not relative to any src, dst couple.
+        # Paths that match are replaced without creating any Path objects.
+        replaced = get_path_matcher(to_replace).apply(d)
+        if replaced is not None:
+            return replaced, 1, 0
         try:
             p = Path(d)
         except:
@@ -133,40 +378,22 @@ def recursive_root_path_replacer(d, to_replace: dict, position: int = 0):
             # object (which is equivalent to saying it doesn't have any restrictions for filenames).
             ignored += 1
         else:
-            found = False
-            for src, dst in to_replace.items():
-                if p.is_relative_to(src):
-                    # This filters out all the "garbage" paths that actually were no paths to begin with
-                    # and of course all the paths that are actually not relative to the src, dst couple
-                    # currently checked.
-                    p = dst / p.relative_to(src)
-                    # I guess 99% of the users won't migrate _to_ windows but the script could generate
-                    # \ paths anyways.
-                    # p.as_posix() makes sure that we always get a string with "/". Otherwise, on windows,
-                    # str(p) would automatically return "\" paths.
-                    d = p.as_posix().replace(
-                        "/", to_replace["target_path_slash"])
-                    found = True
-                    break
-            if found:
-                modified += 1
-            else:
-                ignored += 1
-                # No need to consider all the Path("sometext") objects. This might not be 100%
-                # accurate, but it eliminates 99.9999% of the false-positives. This output is
-                # after all only to give you a hint whether you missed a path.
-                # Also exclude URLs. Btw: pathlib can be quite handy for messing with URLs.
-                if len(p.parents) > 1:
-                    if not isinstance(d, str):
-                        d = str(d)
-                    try:
-                        if not d.startswith("https:") \
-                                and not d.startswith("http:") \
-                                and not to_replace.get("log_no_warnings", False):
-                            logging.debug(
-                                f"No entry for this (presumed) path: {d}")
-                    except Exception as e:
-                        print(f'Warning {d}: {e}')
+            ignored += 1
+            # No need to consider all the Path("sometext") objects. This might not be 100%
+            # accurate, but it eliminates 99.9999% of the false-positives. This output is
+            # after all only to give you a hint whether you missed a path.
+            # Also exclude URLs. Btw: pathlib can be quite handy for messing with URLs.
+            if len(p.parents) > 1:
+                if not isinstance(d, str):
+                    d = str(d)
+                try:
+                    if not d.startswith("https:") \
+                            and not d.startswith("http:") \
+                            and not to_replace.get("log_no_warnings", False):
+                        logging.debug(
+                            f"No entry for this (presumed) path: {d}")
+                except Exception as e:
+                    print(f'Warning {d}: {e}')
     return d, modified, ignored
 
 
@@ -176,28 +403,26 @@ def recursive_root_path_replacer(d, to_replace: dict, position: int = 0):
 # important to note and change that parent folder with the firs byte of the id, too.
 # Sometimes the parent folder is just single digit. This code handles any subsring that
 # starts at the beginning of the id string.
-def recursive_id_path_replacer(d, to_replace: dict, position: int = 0):
+def recursive_id_path_replacer(d, to_replace: dict):
+    return replace_nested(d, to_replace, replace_id_path)
+
+
+# Replaces the IDs in a single path (string or path object) according to to_replace.
+# Anything else is returned unmodified. See recursive_id_path_replacer.
+@cache_leaves
+def replace_id_path(d, to_replace: dict):
     modified, ignored = 0, 0
-    if type(d) is dict:
-        if len(d) > 100:
-            pbar = tqdm(d.items(), position=position)
-        else:
-            pbar = d.items()
-        for k, v in pbar:
-            d[k], mo, ig = recursive_id_path_replacer(
-                v, to_replace, position=position+1)
-            modified += mo
-            ignored += ig
-    elif type(d) is list:
-        if len(d) > 100:
-            pbar = tqdm(enumerate(d), total=len(d), position=position)
-        else:
-            pbar = enumerate(d)
-        for i, e in pbar:
-            d[i], mo, ig = recursive_id_path_replacer(
-                e, to_replace, position=position+1)
-            modified += mo
-            ignored += ig
+    if type(d) is str and "/" not in d and "\\" not in d and "." not in d:
+        # Most of the strings aren't paths at all. Without any (back)slashes or dots the whole string
+        # is the stem of the path, so there's no need to build a Path object to look it up.
+        dst = to_replace.get(d, "") if ID_CHARS.issuperset(d) else ""
+        if dst:
+            return dst.replace("/", to_replace["target_path_slash"]), 1, 0
+        return d, 0, 1
+    elif type(d) is str and not any(token in to_replace for token in ID_TOKEN_RE.findall(d)):
+        # Any ID that can be replaced below (a part or the stem of the path) is a complete run of
+        # ID characters. If none of those is in the dict, there's nothing to replace.
+        return d, 0, 1
     elif type(d) is str or isinstance(d, pathlib.PurePath):
         try:
             p = Path(d)
@@ -210,16 +435,18 @@ def recursive_id_path_replacer(d, to_replace: dict, position: int = 0):
 
             src, dst = "", ""
 
-            if set(p.stem).issubset(set("0123456789abcdef-")):
-                dst = to_replace.get(p.stem, "")
+            stem = p.stem
+            if ID_CHARS.issuperset(stem):
+                dst = to_replace.get(stem, "")
                 if dst:
                     found = True
                     p = p.with_stem(dst)
 
             if not found:
-                for part in p.parts[:-1]:
+                parts = p.parts
+                for part in parts[:-1]:
                     # Check if it can actually be an ID. If so, look it up (which is expensive).
-                    if set(part).issubset(set("0123456789abcdef-")):
+                    if ID_CHARS.issuperset(part):
                         src = part
                         dst = to_replace.get(part, "")
                         if dst:
@@ -261,6 +488,114 @@ def recursive_id_path_replacer(d, to_replace: dict, position: int = 0):
     return d, modified, ignored
 
 
+# Pragmas that trade durability for speed. Fine here since the script works on copies of
+# the database files anyway; if anything goes wrong, the migration is simply run again.
+# The journal is kept in memory rather than using WAL mode, which would be stored in the files
+# and handed over to jellyfin.
+DB_PRAGMAS = (
+    "journal_mode=MEMORY",
+    "synchronous=OFF",
+    "cache_size=-262144",
+    "temp_store=MEMORY",
+    "locking_mode=EXCLUSIVE",
+    "mmap_size=1073741824",
+)
+
+
+def tune_db_connection(con: sqlite3.Connection):
+    for pragma in DB_PRAGMAS:
+        con.execute(f"PRAGMA {pragma}")
+
+
+# Opens a (target) database for update_db_table and co. The transactions are managed manually, hence no
+# implicit transactions by sqlite3. The cached statements are reused for the different
+# UPDATE queries.
+def open_db(file, check_same_thread: bool = True) -> sqlite3.Connection:
+    con = sqlite3.connect(file, isolation_level=None, detect_types=0, cached_statements=256,
+                          check_same_thread=check_same_thread)
+    tune_db_connection(con)
+    return con
+
+
+# Number of updated rows written to the database at once by update_db_table.
+UPDATE_BATCH_SIZE = 5000
+# Number of rows read from the database at once by iter_db_table_rows.
+SELECT_BATCH_SIZE = 5000
+
+
+# Parses a json string. Uses orjson if available; json is still used for anything orjson can't
+# handle (f. ex. NaN).
+def json_loads(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+# Converts the object to a json string. Uses orjson if available (see json_loads).
+# orjson only supports indent=2 (or none).
+def json_dumps(obj, indent: Optional[int] = None) -> str:
+    if orjson is not None and indent in (None, 2):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None).decode()
+        except TypeError:
+            pass
+    return json.dumps(obj, indent=indent)
+
+
+# Matches the path of each image structure within the Jellyfin image metadata (see update_db_table)
+# together with the preceding separator.
+JF_IMAGE_PATH_RE = re.compile(r"(^|\|)([^*|]+)")
+
+
+# Yields the rowid together with the given columns of all rows of the table, reading
+# SELECT_BATCH_SIZE rows at a time (ordered by rowid) instead of the whole table at once.
+# Each batch is read completely before it's yielded; hence the rows can be updated while
+# iterating over them without breaking the query.
+def iter_db_table_rows(con: sqlite3.Connection, table: str, columns: str):
+    query = f"SELECT `rowid`, {columns} FROM `{table}` WHERE `rowid` >= ? ORDER BY `rowid` LIMIT ?"
+    # rowids are signed 64 bit integers.
+    first = -(1 << 63)
+    while True:
+        rows = con.execute(query, (first, SELECT_BATCH_SIZE)).fetchall()
+        yield from rows
+        if len(rows) < SELECT_BATCH_SIZE:
+            return
+        first = rows[-1][0] + 1
+
+
+# Writes the updates collected by update_db_table to the table and clears them.
+# updates has the structure {(column names): [(new values..., rowid), ...]}.
+def write_db_table_updates(cur, table, updates: dict):
+    for columns, args in updates.items():
+        if not args:
+            continue
+        # Similar to the initial query we construct a comma separated list of the columns, only this
+        # time we write
+        #     `columnname` = ?
+        # While the new values are all strings, the question mark avoids any issues with handling
+        # backslashes etc. The library offers an easy, built-in way to do it so there's no reason
+        # to mess with it myself.
+        keys = ", ".join([f"`{k}` = ?" for k in columns])
+        query = f"UPDATE `{table}` SET {keys} WHERE `rowid` = ?"
+        try:
+            cur.executemany(query, args)
+        except Exception as e:
+            # This was mainly for debugging purposes and shouldn't be reached anymore. Doesn't
+            # hurt to have it though.
+            logging.error(f'Error: {e} on query {query}')
+            exit()
+        else:
+            if cur.rowcount < len(args):
+                # This was mainly for debugging purposes and shouldn't be reached anymore.
+                # Doesn't hurt to have it though.
+                logging.debug(f'Not all rows modified on query {query}')
+                exit()
+        args.clear()
+
+
 def update_db_table(
         file,
         replace_dict,
@@ -269,13 +604,18 @@ def update_db_table(
         path_columns=(),
         json_columns=(),
         jf_image_columns=(),
-        preview=False
+        preview=False,
+        con: Optional[sqlite3.Connection] = None
 ):
     # Initialize local variables
     rows_count, modified, ignored = 0, 0, 0
 
     # Initialize sqlite3 objects
-    con = sqlite3.connect(file)
+    # If a connection (see open_db) is passed, it's used instead and left open; this way
+    # multiple tables of the same file can be processed with the same connection.
+    own_con = con is None
+    if own_con:
+        con = open_db(file)
     cur = con.cursor()
 
     # If only one item has been specified, convert it to a list with one item instead.
@@ -296,39 +636,30 @@ def update_db_table(
     columns = ", ".join([f"`{e}`" for e in list(
         json_columns) + list(path_columns)] + list(jf_image_columns))
 
-    # Query the unique IDs of all rows. Note: we cannot iterate over the rows using
+    # Query the unique IDs of all rows together with the columns we want to check/modify.
+    # Note: we cannot update the rows while iterating over
     #     for row in cur.execute(get rows)
-    # because the rows are modified by the loop, which breaks that iterator. Hence
-    # the solution with reading all row ids and iterating over them instead.
-    # Note: The cur.execute yields tuples with all the columns queried. Which means that
-    # the array below actually contains _tuples_ with the id. This is however desirable
-    # in our case; see below where id is used.
-    todo = [rowid for rowid in cur.execute(
-        f"SELECT `rowid` FROM `{table}`") if rowid[0]]
-    rows_count = len(todo)
-    pbar = tqdm(enumerate(todo),
-                total=rows_count) if rows_count > 100 else enumerate(todo)
-    for progress, id in pbar:
-
-        # Query the columns we want to check/modify of the current row (selected by id).
-        # Since the id is a binary object, it's not directly included in the f-string.
-        # The cur.execute expects as second argument a _tuple_ with as many elements as
-        # there are ? characters in the query string. This is the reason why we kept the
-        # IDs as tuple. The only other place where this id is used is in the update query
-        # at the end of the loop which requires - just like here - a tuple.
-        row = [r for r in cur.execute(
-            f"SELECT {columns} FROM `{table}` WHERE `rowid` = ?", id)]
-        # This _should_ not occur, but I think I have seen it happen rarely. Safe is safe.
-        if len(row) != 1:
-            logging.warning(
-                f"Error with rowid {id}! Resulted in {len(row)} rows instead of 1. Skipping.")
+    # because the rows are modified by the loop, which breaks that iterator. Hence the rows
+    # are read in batches (see iter_db_table_rows) and the updates are written in batches, too.
+    # All the updates are done within one transaction. A savepoint starts a transaction if
+    # there's none yet, and otherwise it's nested in the caller's transaction.
+    cur.execute("SAVEPOINT update_db_table")
+    total = cur.execute(f"SELECT COUNT(*) FROM `{table}`").fetchone()[0]
+
+    # The updated rows, grouped by the columns that changed. Each group uses the same UPDATE
+    # query, so it can be passed to executemany as one batch.
+    updates = dict()
+
+    rows = iter_db_table_rows(con, table, columns)
+    pbar = tqdm(rows, total=total) if total > 100 else rows
+    for row in pbar:
+        # The rowid is only used in the update query at the end of the loop.
+        id = row[0]
+        if not id:
             continue
-        # cur.execute returns a 2D tuple, containing all rows matching the query, and then
-        # in each row the selected columns. We only selected a single row, hence row[0] is
-        # all we care about (and all there is, see error handling above).
-        # Secondly we want row to be modifiable, hence the conversion to a list.
-        # list(row[0]) would btw return a list with 1 element: the tuple of the columns.
-        row = [e for e in row[0]]
+        rows_count += 1
+        # We want row to be modifiable, hence the conversion to a list.
+        row = [e for e in row[1:]]
 
         # result has the structure {column_name: updated_data} which makes it very easy to build
         # the update query at the end.
@@ -342,12 +673,16 @@ def update_db_table(
         for i, data in enumerate(jsons):
             if data:
                 # There are numerous rows that have empty columns which would result in an error
-                # from json.loads. Just skip them
-                data = json.loads(data)
+                # from json_loads. Just skip them
+                # The same goes for the (many) rows that can't contain any of the paths.
+                if replace_func is recursive_root_path_replacer \
+                        and not get_path_matcher(replace_dict).may_match(data):
+                    continue
+                data = json_loads(data)
                 data, mo, ig = replace_func(data, replace_dict)
                 modified += mo
                 ignored += ig
-                result[json_columns[i]] = json.dumps(data)
+                result[json_columns[i]] = json_dumps(data)
         for i, path in enumerate(paths):
             # One could also skip the empty objects here, but recursive_path_replacer handles them
             # just fine (leaves them untouched).
@@ -367,60 +702,48 @@ def update_db_table(
             # https://github.com/jellyfin/jellyfin/blob/045761605531f98c55f379ac9eb5b5b6004ef670/Emby.Server.Implementations/Data/SqliteItemRepository.cs#L1118 # noqa
             if not imgs:
                 continue
-            imgs = imgs.split("|")
-            for j, img_properties in enumerate(imgs):
-                if not img_properties:
-                    continue
-                img_properties = img_properties.split("*")
-                # path = first property
-                img_properties[0], mo, ig = replace_func(
-                    img_properties[0], replace_dict)
-                imgs[j] = "*".join(img_properties)
-                modified += mo
-                ignored += ig
-            imgs = "|".join(imgs)
+            # path = first property of each structure.
+            counts = [0, 0]
+
+            def replace_img_path(m):
+                path, mo, ig = replace_func(m.group(2), replace_dict)
+                counts[0] += mo
+                counts[1] += ig
+                return m.group(1) + path
+
+            imgs = JF_IMAGE_PATH_RE.sub(replace_img_path, imgs)
+            modified += counts[0]
+            ignored += counts[1]
             result[jf_image_columns[i]] = imgs
 
-        # Similar to the initial query we construct a comma separated list of the columns, only this
-        # time we write
-        #     `columnname` = ?
-        # While the new values are all strings, the question mark avoids any issues with handling
-        # backslashes etc. The library offers an easy, built-in way to do it so there's no reason
-        # to mess with it myself.
-        # Note that this relies on result.keys() and result.values() returning the entries in the
-        # same order (which is guaranteed).
-        # Note: it can happen that no changes are made at all. In this case we can abort here and
-        #       go for the next job from the todo_list.
+        # Note: it can happen that no changes are made at all. In this case we can skip the row.
         if not result:
             continue
-        keys = ", ".join([f"`{k}` = ?" for k in result.keys()])
-        query = f"UPDATE `{table}` SET {keys} WHERE `rowid` = ?"
-
-        # The query has a question mark for each updated column plus one for the id to identify
-        # the correct row.
-        args = tuple(result.values()) + id
-        try:
-            cur.execute(query, args)
-        except Exception as e:
-            # This was mainly for debugging purposes and shouldn't be reached anymore. Doesn't
-            # hurt to have it though.
-            logging.error(f'Error: {e} on query {query}({args})')
-            exit()
-        else:
-            if cur.rowcount < 1:
-                # This was mainly for debugging purposes and shouldn't be reached anymore.
-                # Doesn't hurt to have it though.
-                logging.debug(f'No data modified on query {query}({args})')
-                exit()
+        # The arguments have a value for each updated column plus the id to identify the correct row.
+        # Note that this relies on result.keys() and result.values() returning the entries in the
+        # same order (which is guaranteed).
+        batch = updates.setdefault(tuple(result.keys()), [])
+        batch.append(tuple(result.values()) + (id,))
+        if len(batch) >= UPDATE_BATCH_SIZE:
+            write_db_table_updates(cur, table, updates)
+    write_db_table_updates(cur, table, updates)
     logging.info(f"Processed {rows_count} rows in table {table}. ")
     logging.info(f"{modified} paths have been modified.")
 
     # Once again, this came from the development and is not required anymore, especially
     # since by default the script is working on copies of the original files.
-    if not preview:
-        # Write the updated database back to the file.
-        con.commit()
-    con.close()
+    if preview:
+        cur.execute("ROLLBACK TO update_db_table")
+    # Write the updated database back to the file (or keep it for the caller's transaction).
+    cur.execute("RELEASE update_db_table")
+    if own_con:
+        con.close()
+
+
+# Exclude a few tags known to contain no paths.
+# biography, outline: These often contain lots of text (= slow to process) and generate
+# false-positives for the missed path detection (see recursive_root_path_replacer)
+XML_SKIP_TAGS = frozenset(("biography", "outline"))
 
 
 # Walks through an XML file and checks *all* entries.
@@ -429,26 +752,112 @@ def update_db_table(
 # issue here though.
 def update_xml(file: Path, replace_dict: dict, replace_func) -> None:
     modified, ignored = 0, 0
-    tree = ET.parse(file)
-    root = tree.getroot()
-    for el in root.iter():
-        # Exclude a few tags known to contain no paths.
-        # biography, outline: These often contain lots of text (= slow to process) and generate
-        # false-positives for the missed path detection (see recursive_root_path_replacer)
-        if el.tag in ("biography", "outline"):
+    if HAVE_LXML:
+        # lxml parses the whole file faster than it reports the elements one by one while
+        # parsing. Its iter can skip the comments and processing instructions by itself.
+        tree = ET.parse(str(file))
+        elements = tree.iter(tag=ET.Element)
+    else:
+        # Process the elements while parsing; each one is complete once its end tag was read.
+        # They can't be cleared afterwards though since the whole tree is written back.
+        context = ET.iterparse(str(file), events=("end",))
+        elements = (el for _, el in context)
+    for el in elements:
+        # Elements without any text can't contain a path either.
+        if el.text is None or el.tag in XML_SKIP_TAGS:
             continue
         el.text, mo, ig = replace_func(el.text, replace_dict)
         modified += mo
         ignored += ig
     logging.info(
         f"Processed {ignored + modified} elements. {modified} paths have been modified.")
-    tree.write(file)  # , encoding="utf-8")
+    if not HAVE_LXML:
+        tree = ET.ElementTree(context.root)
+    tree.write(str(file))  # , encoding="utf-8")
+
+
+# Checks quickly whether a text file may contain any path to be replaced by
+# recursive_root_path_replacer, without parsing it. See PathMatcher.may_match.
+def may_contain_paths(file: Path, to_replace: dict) -> bool:
+    matcher = get_path_matcher(to_replace)
+    if not matcher.names_complete:
+        # Every file may contain paths then; reading it here would be wasted.
+        return True
+    data = file.read_bytes()
+    # The names are searched as ASCII bytes which doesn't work for UTF-16/32 encoded files.
+    if b"\x00" in data:
+        return True
+    # These files aren't necessarily written by jellyfin. Other programs (or people) may escape
+    # any character, even the ones may_match relies on, with json escapes or xml character
+    # references.
+    if b"\\u" in data or b"&#" in data:
+        return True
+    return matcher.may_match(data)
+
+
+# Copies the file including its permission bits, just like shutil.copy. Where available,
+# os.copy_file_range lets the kernel copy the data without passing it through this process
+# (or even share the data blocks on file systems that support it, like btrfs and xfs).
+# The files are handled by their file descriptors to save the additional stat calls of
+# shutil.copy2. Just like copy2, the modification time is kept; see target_is_up_to_date.
+def copy_file(source: Path, target: Path) -> None:
+    if not hasattr(os, "copy_file_range"):
+        copy2(source, target)
+        return
+    fsrc = os.open(source, os.O_RDONLY)
+    try:
+        st = os.fstat(fsrc)
+        fdst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            copied = 0
+            try:
+                while n := os.copy_file_range(fsrc, fdst, 1 << 30):
+                    copied += n
+            except OSError:
+                copied = -1
+            os.fchmod(fdst, stat.S_IMODE(st.st_mode))
+        finally:
+            os.close(fdst)
+    finally:
+        os.close(fsrc)
+    if copied != st.st_size:
+        # Not supported by the (combination of) file systems; copy it the regular way. Some of
+        # them (f. ex. FUSE mounts) just stop copying early instead of raising an error.
+        copyfile(source, target)
+    os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+# Checks whether target is an unmodified copy of source from a previous run. Copies keep the
+# modification time of the source (see copy_file) while processing a file gives it a new one,
+# so if size and modification time are the same, copying it again wouldn't change anything.
+def target_is_up_to_date(source: Path, target: Path) -> bool:
+    try:
+        s_src = os.stat(source)
+        s_tgt = os.stat(target)
+    except OSError:
+        return False
+    return s_src.st_size == s_tgt.st_size and s_src.st_mtime_ns == s_tgt.st_mtime_ns
+
+
+# Folders that have been created (or found to exist) by get_target.
+created_dirs = set()
 
 
 # Remember if the user wants to ignore all future warnings.
 user_wants_inplace_warning = False  # disabled for now
 
 
+# String of root with a trailing separator. Any path inside root starts with it.
+# None for drive relative paths like "C:"; there's no such prefix for them.
+@lru_cache(maxsize=None)
+def root_prefix(root: pathlib.PurePath) -> Optional[str]:
+    if root.drive and not root.root:
+        return None
+    prefix = str(root)
+    sep = "\\" if isinstance(root, pathlib.PureWindowsPath) else "/"
+    return prefix if prefix.endswith(sep) else prefix + sep
+
+
 def get_target(
         source: Path,
         target: Path,
@@ -472,7 +881,15 @@ def get_target(
     if len(target.parts) == 1 and target.name.startswith("auto"):
         if target.name == "auto-existing":
             skip_copy = True
-        original_source = original_root / source.relative_to(source_root)
+        # Swapping the roots of the strings is the same as original_root / relative path but
+        # saves creating the intermediate Path objects for every single file.
+        source_str = str(source)
+        source_prefix = root_prefix(source_root)
+        original_prefix = root_prefix(original_root)
+        if source_prefix and original_prefix and source_str.startswith(source_prefix):
+            original_source = original_prefix + source_str[len(source_prefix):]
+        else:
+            original_source = original_root / source.relative_to(source_root)
         target, idgaf1, idgaf2 = recursive_root_path_replacer(
             original_source, to_replace=replacements)  # type: ignore
         target, idgaf1, idgaf2 = recursive_root_path_replacer(
@@ -510,13 +927,18 @@ def get_target(
                 # Don't warn about this anymore.
                 user_wants_inplace_warning = False
     elif not skip_copy:
-        if not target.parent.exists():
-            target.parent.mkdir(parents=True)
-        if not no_log:
-            logging.info(f"Copying... {target}")
-        copy(source, target)
-        if not no_log:
-            logging.info("Done.")
+        if target.parent not in created_dirs:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            created_dirs.add(target.parent)
+        if target_is_up_to_date(source, target):
+            if not no_log:
+                logging.info(f"Already copied: {target}")
+        else:
+            if not no_log:
+                logging.info(f"Copying... {target}")
+            copy_file(source, target)
+            if not no_log:
+                logging.info("Done.")
     return target
 
 
@@ -562,6 +984,11 @@ def process_file(
     if copy_only:
         # No need to do any further checks.
         return
+    elif replace_func is recursive_root_path_replacer \
+            and target.suffix in (".xml", ".nfo", ".mblink", ".json") \
+            and not may_contain_paths(target, replacements):
+        # Most of these files don't contain any of the paths; no need to parse them.
+        logging.debug(f"No paths to replace in {target}")
     elif target.suffix == ".db":
         # If it's "library.db", save it for later (see comment at declaration):
         if target.name == "library.db":
@@ -569,37 +996,52 @@ def process_file(
             library_db_source_path = source
             library_db_target_path = target
         # sqlite file. In this case table specifies which tables within that file have columns to check.
-        # Iterate over those.
-        for table, kwargs in tables.items():
-            logging.debug(f"Processing table {table}")
-            # The remaining function arguments (**kwards) contain the details about the columns to process.
-            # See update_db_table and/or the todo_list.
-            update_db_table(file=target, replace_dict=replacements,
-                            replace_func=replace_func, table=table, **kwargs)
+        # Iterate over those. All of them are processed with the same connection and transaction.
+        # Without any tables, the file isn't opened at all (it may not even be an sqlite file,
+        # f. ex. Thumbs.db, and open_db would switch it to WAL mode).
+        if tables:
+            con = open_db(target)
+            try:
+                con.execute("BEGIN")
+                for table, kwargs in tables.items():
+                    logging.debug(f"Processing table {table}")
+                    # The remaining function arguments (**kwards) contain the details about the columns to process.
+                    # See update_db_table and/or the todo_list.
+                    update_db_table(file=target, replace_dict=replacements,
+                                    replace_func=replace_func, table=table, con=con, **kwargs)
+                con.execute("COMMIT")
+            finally:
+                con.close()
     elif target.suffix == ".xml" or target.suffix == ".nfo":
         update_xml(file=target, replace_dict=replacements,
                    replace_func=replace_func)
     elif target.suffix == ".mblink":
         # .mblink files only contain a path, nothing else.
-        with open(target, "r", encoding="utf-8") as f:
-            path = f.read()
-        path, modified, ignored = replace_func(path, replacements)
-        logging.info(
-            f"Processed {modified + ignored} paths, {modified} paths have been modified.")
-        with open(target, "w", encoding="utf-8") as f:
-            f.write(path)
+        # The file is opened once for reading and writing. The newlines are handled like text
+        # mode would do it, so the output is the same as reading and writing it separately.
+        with open(target, "r+b") as f:
+            data = f.read()
+            path = data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+            path, modified, ignored = replace_func(path, replacements)
+            logging.info(
+                f"Processed {modified + ignored} paths, {modified} paths have been modified.")
+            new_data = path.replace("\n", os.linesep).encode("utf-8")
+            if new_data != data:
+                f.seek(0)
+                f.write(new_data)
+                f.truncate()
     elif target.suffix == ".json":
         # There are also json files with the ending .js but I haven't found any with paths.
         # Load the file by the json module (resulting in a dict or list object) and process
         # them by recursive_path_replacer which handles these structures.
         with open(target, "r", encoding="utf-8") as f:
-            j = json.load(f)
+            j = json_loads(f.read())
         j, modified, ignored = replace_func(j, replacements)
         logging.info(
             f"Processed {modified + ignored} paths, {modified} paths have been modified.")
         with open(target, "w", encoding="utf-8") as f:
             # indent 2 seems to be the default formatting for jellyfin json files.
-            json.dump(j, f, indent=2)
+            f.write(json_dumps(j, indent=2))
 
     # If we're updating path ids we also need to check the paths of the files themselves
     # and move them if they're relative to a path.
@@ -643,13 +1085,7 @@ def process_file(
 # lst: job list
 # process_func: function to apply to jobs of lst.
 # replace_func: function used by process_func to do the replacing of paths, ...
-def process_files_proc(src: Path, process_func, replace_func, path_replacements, job: dict, donelist: List[Path]):
-    if src.is_dir():
-        return None
-    if src in donelist:
-        # File has already been processed by this script.
-        return None
-
+def process_files_proc(src: Path, process_func, replace_func, path_replacements, job: dict):
     target = get_target(
         source=src,
         target=job["target"],
@@ -670,6 +1106,85 @@ def process_files_proc(src: Path, process_func, replace_func, path_replacements,
     return src
 
 
+# Arguments of process_files_proc besides the file. They're the same for all the files of a
+# wildcard job, so they're sent to each worker process once by pool_init_job instead of with
+# every chunk of files. This also keeps the replacement dicts (and their caches, see
+# get_path_matcher and cache_leaves) the same objects for the whole job.
+pool_job_args = dict()
+
+
+def pool_init_job(globals: dict, job_args: dict):
+    global pool_job_args
+    pool_init_globals(globals)
+    pool_job_args = job_args
+
+
+def pool_process_files_proc(src: Path):
+    return process_files_proc(src, **pool_job_args)
+
+
+# Splits a path with wildcards into the folder before the first wildcard and the remaining
+# pattern. The folder can then be checked directly instead of having glob look for every single
+# part of it.
+def split_glob(path: Path) -> Tuple[Path, str]:
+    parts = Path(path).parts
+    i = 0
+    while i < len(parts) and not any(c in parts[i] for c in "*?["):
+        i += 1
+    return Path(*parts[:i]), Path(*parts[i:]).as_posix()
+
+
+# Equivalent to root.glob(pattern) but only yields the files, not the folders.
+# Walks the folders with os.scandir and only creates Path objects for the matching files,
+# which is quite a bit faster than Path.glob for large folder trees. The components of the
+# pattern are compiled once and matched against the file names of the DirEntry objects, whose
+# type is known from the directory listing already. Just like Path.glob, symlinks to folders
+# are not followed by "**".
+def iter_matching(root: Path, pattern: str):
+    flags = re.IGNORECASE if os.name == "nt" else 0
+    # None stands for "**", i. e. any number of folders.
+    parts = [None if part == "**" else re.compile(translate(part), flags).match
+             for part in pattern.split("/")]
+    last = len(parts) - 1
+    # Pattern components that are reached from the i-th one without going into a subfolder.
+    # Only differs from {i} for "**", which also matches no folder at all.
+    states = []
+    for i in range(len(parts)):
+        j = i
+        while parts[j] is None and j < last:
+            j += 1
+        states.append(frozenset(range(i, j + 1)))
+
+    stack = [(str(root), states[0])]
+    while stack:
+        path, current = stack.pop()
+        try:
+            it = os.scandir(path)
+        except PermissionError:
+            # Path.glob silently skips these folders, too.
+            continue
+        with it:
+            for entry in it:
+                is_dir = entry.is_dir()
+                subfolder = set()
+                found = False
+                for i in current:
+                    match = parts[i]
+                    if match is None:
+                        if is_dir and not entry.is_symlink():
+                            subfolder |= states[i]
+                    elif match(entry.name):
+                        if i < last:
+                            if is_dir:
+                                subfolder |= states[i + 1]
+                        elif not is_dir:
+                            found = True
+                if found:
+                    yield Path(entry.path)
+                if subfolder:
+                    stack.append((entry.path, subfolder))
+
+
 def process_files(lst: list, process_func, replace_func, path_replacements):
     done = set()
     for job in lst:
@@ -681,40 +1196,16 @@ def process_files(lst: list, process_func, replace_func, path_replacements):
             # Path has wildcards, process all matching files.
             #
             # Ironically Path.glob can't handle Path objects, hence the need
-            # to convert them to a string...
+            # to convert them to a string (see split_glob)...
             # It is expected that all these paths are relative to source_root.
-            source = source.relative_to(source_root)
-            srcglob = list(source_root.glob(str(source)))
-            srcglob_len = len(srcglob)
-            if srcglob_len < 100:
-                for src in srcglob:
-                    if src.is_dir():
-                        continue
-                    if src in done:
-                        # File has already been processed by this script.
-                        continue
-                    done.add(src)
-
-                    target = get_target(
-                        source=src,
-                        target=job["target"],
-                        replacements=path_replacements,
-                        no_log=job["no_log"],
-                    )
-
-                    # pass the job as is but with non-wildcard source path.
-                    replacements = {k: v for k, v in job.items(
-                    ) if k not in ("source", "target")}
-                    process_func(
-                        replace_func=replace_func,
-                        source=src,
-                        target=target,
-                        **replacements,
-                    )
-            elif srcglob_len >= 100 and user_wants_inplace_warning:
-                for src in tqdm(srcglob, total=srcglob_len):
-                    if src.is_dir():
-                        continue
+            root, pattern = split_glob(source)
+            # Only files are returned by iter_matching, the folders are skipped already.
+            srcglob = iter_matching(root, pattern) if root.is_dir() else iter(())
+            # Only the first 100 files are collected to decide whether multiprocessing is worth it.
+            # The remaining ones are processed while they're still being searched for.
+            head = list(islice(srcglob, 100))
+            if len(head) < 100 or user_wants_inplace_warning:
+                for src in head if len(head) < 100 else tqdm(chain(head, srcglob)):
                     if src in done:
                         # File has already been processed by this script.
                         continue
@@ -739,20 +1230,26 @@ def process_files(lst: list, process_func, replace_func, path_replacements):
             else:
                 logging.info(f'Using multiprocessing for {source}')
 
+                # Only hand out the files that haven't been processed yet. Just like above, they're
+                # marked as done before being processed. This also avoids sending the whole done
+                # set to the worker processes.
+                def todo(files):
+                    for src in files:
+                        if src in done:
+                            # File has already been processed by this script.
+                            continue
+                        done.add(src)
+                        yield src
+
                 with DisableLogger():
                     logging.info("This message will not crop up")
-                    evalfunc = partial(process_files_proc, process_func=process_func,
-                                       replace_func=replace_func, path_replacements=path_replacements, job=job, donelist=done)  # type: ignore
-                    CHUNK_SIZE = 2000
-                    srcglobs = partition(srcglob, CHUNK_SIZE)  # partition
-                    srcglobs_len = math.ceil(srcglob_len / CHUNK_SIZE)
-                    with Pool(initializer=pool_init_globals, initargs=(get_globals(),)) as mpool:
-                        for srcglob in tqdm(srcglobs, total=srcglobs_len):
-                            donelist = mpool.map(
-                                evalfunc, srcglob, chunksize=100)
-                            donelist = list(filter(None, donelist))
-                            for d in donelist:
-                                done.add(d)
+                    job_args = dict(process_func=process_func, replace_func=replace_func,
+                                    path_replacements=path_replacements, job=job)
+                    with Pool(os.cpu_count(), initializer=pool_init_job,
+                              initargs=(get_globals(), job_args)) as mpool:
+                        for _ in tqdm(mpool.imap_unordered(pool_process_files_proc, todo(chain(head, srcglob)),
+                                                           chunksize=32)):
+                            pass
         else:
             # No wildcards, process the path directly - if it hasn't already
             # been processed.
@@ -776,12 +1273,62 @@ def process_files(lst: list, process_func, replace_func, path_replacements):
                 **replacements,
             )
         print("")
+    # The replacement dicts of this todo list won't be used again; free their caches.
+    clear_replacer_caches()
 
 
 # Note: The .NET .Unicode method encodes as UTF16 little endian:
 # https://docs.microsoft.com/en-us/dotnet/api/system.text.encoding.unicode?view=net-6.0
+# The hash is only used as an ID, not for security. Saying so keeps it working on systems
+# where openssl is restricted to FIPS approved algorithms. hashlib.md5 already is openssl's
+# implementation; reusing hash objects (copy()) isn't any faster for these short strings.
 def get_dotnet_MD5(s: str):
-    return hashlib.md5(s.encode("utf-16-le")).digest()
+    return hashlib.md5(s.encode("utf-16-le"), usedforsecurity=False).digest()
+
+
+# Replaces a single ID in the given column. If that results in duplicated entries, the
+# entries with the old ID are deleted instead.
+def update_db_id(cur: sqlite3.Cursor, table: str, column: str, old_id, new_id):
+    try:
+        cur.execute(
+            f"UPDATE `{table}` SET `{column}` = ? WHERE `{column}` = ?", (new_id, old_id))
+    except sqlite3.IntegrityError:
+        col_names = [x[0] for x in cur.execute(
+            f"SELECT name FROM PRAGMA_TABLE_INFO('{table}')")]
+        rows = [x for x in cur.execute(
+            f"SELECT * FROM `{table}` WHERE `{column}` = ?", (old_id,))]
+        rows = [dict(zip(col_names, row)) for row in rows]
+        logging.info(
+            f"Encountered {len(rows)} duplicated entries")
+        for i, row in enumerate(rows):
+            logging.debug(
+                f"Deleting ({i+1}/{len(rows)}): {row}")
+        cur.execute(
+            f"DELETE FROM `{table}` WHERE `{column}` = ?", (old_id,))
+
+
+# Replaces the IDs in the given column one by one, see update_db_id. The updates are
+# written in batches. If a batch fails because of duplicates, it's undone and written
+# again one by one.
+def update_db_ids(cur: sqlite3.Cursor, table: str, column: str, id_replacements: dict):
+    # See comment about iterating over rows while modifying them in update_db_table. Only the
+    # updates are collected while streaming the rows; they're written afterwards.
+    rowcount = cur.execute(
+        f"SELECT COUNT(DISTINCT `{column}`) from `{table}`").fetchone()[0]
+    rows = fetch_rows(cur.connection.execute(
+        f"SELECT DISTINCT `{column}` from `{table}`"))
+    pbar = tqdm(rows, total=rowcount) if rowcount > 100 else rows
+    updates = [(id_replacements[old_id], old_id) for old_id, in pbar if old_id in id_replacements]
+    query = f"UPDATE `{table}` SET `{column}` = ? WHERE `{column}` = ?"
+    for batch in partition(updates, UPDATE_BATCH_SIZE):
+        cur.execute("SAVEPOINT update_db_ids")
+        try:
+            cur.executemany(query, batch)
+        except sqlite3.IntegrityError:
+            cur.execute("ROLLBACK TO update_db_ids")
+            for new_id, old_id in batch:
+                update_db_id(cur, table, column, old_id, new_id)
+        cur.execute("RELEASE update_db_ids")
 
 
 # Derived/copied from update_db_table. I couldn't see a good way to do this without
@@ -800,55 +1347,86 @@ def update_db_table_ids(
     logging.info("Updating Item IDs in database... ")
 
     # Initialize sqlite3 objects
-    con = sqlite3.connect(target)
+    # The transaction is managed manually, see open_db.
+    con = open_db(target)
     cur = con.cursor()
+    cur.execute("BEGIN")
 
     updated_ids_count = 0
-    # That's a very nested loop and could probably be written more efficiently using
-    # multiprocessing and more advanced sqlite queries.
+    # The ID replacements are put into temporary tables (one per id type) so that sqlite can
+    # do the lookups itself; one UPDATE per column is enough then.
+    # All writes go through this one connection (it holds an exclusive lock anyway, see
+    # DB_PRAGMAS), so there's nothing to gain from spreading the work over several processes.
+    id_maps = set()
     for table, columns_by_id_type in tables.items():
         for id_type, columns in columns_by_id_type.items():
+            if not ids[id_type]:
+                # Nothing to replace, no need to scan the columns at all.
+                continue
+            id_map = f"id_map_{id_type}"
+            if id_map not in id_maps:
+                cur.execute(f"CREATE TEMP TABLE `{id_map}` (`old` PRIMARY KEY, `new`)")
+                cur.executemany(f"INSERT INTO `{id_map}` VALUES (?, ?)", ids[id_type].items())
+                id_maps.add(id_map)
             for column in columns:
                 logging.info(f"Updating {column} IDs in table {table}...")
-                # See comment about iterating over rows while modifying them in update_db_table.
-                rows = [r for r in cur.execute(
-                    f"SELECT DISTINCT `{column}` from `{table}`")]
-                rowcount = len(rows)
-                pbar = tqdm(rows, total=rowcount) if rowcount > 100 else rows
-                for old_id, in pbar:
-                    if old_id in ids[id_type]:
-                        new_id = ids[id_type][old_id]
-                        try:
-                            cur.execute(
-                                f"UPDATE `{table}` SET `{column}` = ? WHERE `{column}` = ?", (new_id, old_id))
-                        except sqlite3.IntegrityError:
-                            col_names = [x[0] for x in cur.execute(
-                                f"SELECT name FROM PRAGMA_TABLE_INFO('{table}')")]
-                            rows = [x for x in cur.execute(
-                                f"SELECT * FROM `{table}` WHERE `{column}` = ?", (old_id,))]
-                            rows = [dict(zip(col_names, row)) for row in rows]
-                            logging.info(
-                                f"Encountered {len(rows)} duplicated entries")
-                            for i, row in enumerate(rows):
-                                logging.debug(
-                                    f"Deleting ({i+1}/{len(rows)}): {row}")
-                            cur.execute(
-                                f"DELETE FROM `{table}` WHERE `{column}` = ?", (old_id,))
-                        updated_ids_count += 1
+                count = cur.execute(
+                    f"SELECT COUNT(DISTINCT `{column}`) FROM `{table}` "
+                    f"WHERE `{column}` IN (SELECT `old` FROM `{id_map}`)").fetchone()[0]
+                if not count:
+                    # None of the old IDs is in this column; skip the second pass over the table.
+                    continue
+                cur.execute("SAVEPOINT update_db_table_ids")
+                try:
+                    cur.execute(
+                        f"UPDATE `{table}` SET `{column}` = "
+                        f"(SELECT `new` FROM `{id_map}` WHERE `old` = `{table}`.`{column}`) "
+                        f"WHERE `{column}` IN (SELECT `old` FROM `{id_map}`)")
+                except sqlite3.IntegrityError:
+                    # Some of the new IDs are already in use. Undo the update and replace the
+                    # IDs one by one to find and delete the duplicates.
+                    cur.execute("ROLLBACK TO update_db_table_ids")
+                    update_db_ids(cur, table, column, ids[id_type])
+                cur.execute("RELEASE update_db_table_ids")
+                updated_ids_count += count
 
     # Once again, this came from the development and is not required anymore, especially
     # since by default the script is working on copies of the original files.
     if not preview:
         # Write the updated database back to the file.
-        con.commit()
+        cur.execute("COMMIT")
+    else:
+        cur.execute("ROLLBACK")
     con.close()
     logging.info(f"{updated_ids_count} IDs updated.")
 
 
+# Maximum number of parameters of a single sqlite query (SQLITE_MAX_VARIABLE_NUMBER of older
+# sqlite versions).
+SQLITE_MAX_VARIABLES = 999
+
+
+# Returns {guid: Path} for the given guids from TypedBaseItems. One query per (up to)
+# SQLITE_MAX_VARIABLES guids.
+def get_paths_by_guid(cur: sqlite3.Cursor, guids: list) -> dict:
+    paths = dict()
+    for batch in partition(guids, SQLITE_MAX_VARIABLES):
+        placeholders = ",".join("?" * len(batch))
+        paths.update(cur.execute(
+            f"SELECT `guid`, `Path` FROM `TypedBaseItems` WHERE `guid` IN ({placeholders})", batch))
+    return paths
+
+
+# URI to open a source database read only. Unlike the copies in the target folder, the
+# source files must not be modified, not even by sqlite.
+def get_source_db_uri(file) -> str:
+    return Path(file).resolve().as_uri() + "?mode=ro"
+
+
 def get_ids():
     global library_db_target_path, ids
     logging.info(f'Getting IDs from DB file {library_db_target_path}')
-    con = sqlite3.connect(library_db_target_path)
+    con = open_db(library_db_target_path)
     cur = con.cursor()
 
     id_replacements_bin = dict()
@@ -899,20 +1477,17 @@ def get_ids():
 
     # if there are duplicates, find the matching old_ids to query the lines from the database
     if duplicates:
-        old_ids = []
-        for k, v in id_replacements_str.items():
-            if v in duplicates:
-                old_ids.append(sid2bid(k))
+        duplicates_set = set(duplicates)
+        old_ids = [sid2bid(k) for k, v in id_replacements_str.items() if v in duplicates_set]
 
-        duplicates_new = [next(cur.execute(
-            "SELECT `guid`, `Path` FROM `TypedBaseItems` WHERE `guid` = ?", (guid,))) for guid in old_ids]
+        paths_new = get_paths_by_guid(cur, old_ids)
+        duplicates_new = [(guid, paths_new[guid]) for guid in old_ids]
         # also fetch the old paths for better understanding/debugging
         con.close()
-        con = sqlite3.connect(library_db_source_path)
+        # The source database is only read, see get_source_db_uri.
+        con = sqlite3.connect(get_source_db_uri(library_db_source_path), uri=True)
         cur = con.cursor()
-        duplicates_old = [next(cur.execute(
-            "SELECT `guid`, `Path` FROM `TypedBaseItems` WHERE `guid` = ?", (guid,))) for guid in old_ids]
-        duplicates_old = dict(duplicates_old)
+        duplicates_old = get_paths_by_guid(cur, old_ids)
         con.close()
 
         logging.warning(f"Warning! {len(duplicates)} duplicates detected within new ids. This indicates that you're "
@@ -925,6 +1500,10 @@ def get_ids():
             logging.warning(
                 f"  Item ID: {bid2sid(id)},  Paths (old -> new): {duplicates_old[id]} -> {newpath}")
         input("Press Enter to continue or CTRL+C to abort. ")
+    else:
+        # The connection has to be closed explicitly: it's only freed by the garbage collector
+        # otherwise and keeps the database locked until then (see DB_PRAGMAS).
+        con.close()
 
     return ids
 
@@ -933,6 +1512,11 @@ def update_ids():
     return
 
 
+# Matches the date strings as they're usually found in the jellyfin database (without the
+# fractional seconds). These are converted by jf_date_str_to_python_ns without datetime.
+JF_DATE_RE = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})[ T]([0-9]{2}):([0-9]{2}):([0-9]{2})Z?")
+
+
 def jf_date_str_to_python_ns(s: str):
     # Python datetime has only support for microseconds because of resolution
     # problems. To convert from a date+time to ticks, the fractional seconds
@@ -948,17 +1532,43 @@ def jf_date_str_to_python_ns(s: str):
     # Add trailing zeros til the ns digit, then convert to int, and we have ns.
     subseconds = int(subseconds.split(
         "+")[0].rstrip(ascii_letters).ljust(9, "0"))
-    # Add explicit information about the timezone (UTC+00:00)
-    if not s.endswith('Z'):
-        s += 'Z'
-    # s += "+00:00" # this causes a malformed string error
-    t = int(datetime.datetime.fromisoformat(s).timestamp())
+    valid = False
+    m = JF_DATE_RE.fullmatch(s)
+    if m is not None:
+        y, mo, d, h, mi, sec = map(int, m.groups())
+        valid = (y >= 1 and 1 <= mo <= 12 and 1 <= d and (d <= 28 or d <= calendar.monthrange(y, mo)[1])
+                 and h < 24 and mi < 60 and sec < 60)
+    if valid:
+        # The usual case, the time is UTC anyway.
+        t = calendar.timegm((y, mo, d, h, mi, sec, 0, 0, 0))
+    else:
+        # Anything else (or invalid dates, which raise the same error as before).
+        # Add explicit information about the timezone (UTC+00:00)
+        if not s.endswith('Z'):
+            s += 'Z'
+        # s += "+00:00" # this causes a malformed string error
+        t = int(datetime.datetime.fromisoformat(s).timestamp())
     # Convert to ns
     t *= 1000000000
     t += subseconds
     return t
 
 
+# Matches the year at the beginning of a date string from the jellyfin database.
+JF_DATE_YEAR_RE = re.compile(r"(\d{4})-\d\d-\d\d[ T]")
+
+
+# Checks whether the date string from the jellyfin database is before 1970, i.e.
+# jf_date_str_to_python_ns(s) < 0, which is all update_file_dates needs to know. Since
+# jf_date_str_to_python_ns treats all the dates as UTC, it's enough to compare the year;
+# the full conversion is only done for strings in an unexpected format.
+def jf_date_str_is_negative(s: str) -> bool:
+    m = JF_DATE_YEAR_RE.match(s) if type(s) is str else None
+    if m is not None:
+        return m.group(1) < "1970"
+    return jf_date_str_to_python_ns(s) < 0
+
+
 # Convert a _python_ timestamp (float seconds since epoch, which is os dependent)
 # to a ISO like date string as found in the jellyfin database. I have no idea
 # if this works for all OS'es in all timezones. Very likely not but that whole
@@ -969,30 +1579,77 @@ def get_datestr_from_python_time_ns(time_ns: int):
     # Doesn't matter anyway, we can add the whole sub-second part afterwards.
     time_s = time_ns // 1000000000
     time_frac_s_100ns = (time_ns // 100) % 10000000
-    timestamp = datetime.datetime.utcfromtimestamp(
-        time_s).isoformat(sep=" ", timespec="seconds")
+    tm = time.gmtime(time_s)
+    timestamp = (f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d} "
+                 f"{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}")
     # Add back the sub-seconds part and the UTC time zone
     timestamp += "." + str(time_frac_s_100ns).rjust(7, "0").rstrip("0") + "Z"
     return timestamp
 
 
+# Removes all empty folders below dir (including dir itself if nothing's left). The folders
+# are visited bottom-up, so a parent is only tried once its subfolders are gone already.
+# Where available, os.fwalk is used and the subfolders are removed relative to the file
+# descriptor of their parent, which saves resolving the whole path again for every folder.
 def delete_empty_folders(dir: str):
-    dir = Path(dir)  # type: ignore
+    if not hasattr(os, "fwalk"):
+        for dirpath, dirnames, filenames in os.walk(dir, topdown=False):
+            if filenames:
+                continue
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                # Not empty (f. ex. a subfolder that couldn't be removed or a symlink).
+                continue
+            logging.debug(f"Removing empty folder {dirpath}")
+        return
+
+    for dirpath, dirnames, filenames, dirfd in os.fwalk(dir, topdown=False):
+        for name in dirnames:
+            try:
+                os.rmdir(name, dir_fd=dirfd)
+            except OSError:
+                # Not empty (f. ex. a subfolder that couldn't be removed or a symlink).
+                continue
+            logging.debug(f"Removing empty folder {os.path.join(dirpath, name)}")
+    try:
+        os.rmdir(dir)
+    except OSError:
+        return
+    logging.debug(f"Removing empty folder {dir}")
 
-    done = False
-    while not done:
-        done = True
-        for p in dir.glob("**"):  # type: ignore
-            if not list(p.iterdir()):
-                logging.debug(f"Removing empty folder {p}")
-                p.rmdir()
-                done = False
+
+# Filters the rows of update_file_dates. Only the rows with dates before 1970 are yielded;
+# (rowid, target, date_created_negative, date_modified_negative). Checking the dates is a lot
+# cheaper than checking the file (and sending the row to another process), hence it's done
+# first. Rows with dates that can't be parsed are logged and skipped, no matter whether their
+# file exists (which isn't known yet at this point).
+def rows_with_negative_dates(rows):
+    global library_db_target_path
+
+    for rowid, target, date_created, date_modified in rows:
+        if not target:
+            continue
+
+        try:
+            date_created_negative = jf_date_str_is_negative(date_created)
+        except Exception as e:
+            logging.error(f'{target}: date created error: {e}')
+            continue
+        try:
+            date_modified_negative = jf_date_str_is_negative(date_modified)
+        except Exception as e:
+            logging.error(
+                f'[{library_db_target_path}]{target} date modified error: {e}')
+            continue
+
+        if date_created_negative or date_modified_negative:
+            yield rowid, target, date_created_negative, date_modified_negative
 
 
 def update_file_date_proc(row, fs_path_replacements, target_root) -> Optional[Tuple[int, Optional[str], Optional[str]]]:
-    rowid, target, date_created, date_modified = row
-    if not target:
-        return None
+    rowid, target, date_created_negative, date_modified_negative = row
+
     # Determine file path as seen by this script (see fs_path_replacements for details)
     # Code taken from get_target
     target, _, _ = recursive_root_path_replacer(
@@ -1007,22 +1664,18 @@ def update_file_date_proc(row, fs_path_replacements, target_root) -> Optional[Tu
     # End of code taken from get_target
 
     if not target.exists():
-        return None
-
-    date_created_ns = jf_date_str_to_python_ns(date_created)
-    date_modified_ns = jf_date_str_to_python_ns(date_modified)
-
-    if date_created_ns >= 0 and date_modified_ns >= 0:
+        logging.info(
+            f"File doesn't seem to exist; can't update its dates in the database: {target}")
         return None
 
     filestats = os.stat(target)
 
-    if date_created_ns < 0:
+    if date_created_negative:
         new_date_created = get_datestr_from_python_time_ns(
             filestats.st_ctime_ns)
     else:
         new_date_created = None
-    if date_modified_ns < 0:
+    if date_modified_negative:
         new_date_modified = get_datestr_from_python_time_ns(
             filestats.st_mtime_ns)
     else:
@@ -1036,86 +1689,39 @@ def update_file_dates(parallel: bool = False):
     logging.info("Updating file dates... Note: Reading file dates seems to be quite slow. "
                  "This will take a couple minutes")
 
-    con = sqlite3.connect(library_db_target_path)
+    # The transaction is managed manually, see open_db.
+    # In parallel mode, the rows are read by the task handler thread of the pool. The
+    # connection is never used by two threads at the same time though.
+    con = open_db(library_db_target_path, check_same_thread=not parallel)
     cur = con.cursor()
+    cur.execute("BEGIN")
 
-    rows = [r for r in cur.execute(
-        "SELECT `rowid`, `Path`, `DateCreated`, `DateModified` FROM `TypedBaseItems`")]
+    # The rows are streamed from the database; nothing is written before all of them have been
+    # processed. Only the rows that need to be updated are passed on to update_file_date_proc
+    # (and thus to the worker processes).
+    rowcount = cur.execute("SELECT COUNT(*) FROM `TypedBaseItems`").fetchone()[0]
+    rows = fetch_rows(con.execute(
+        "SELECT `rowid`, `Path`, `DateCreated`, `DateModified` FROM `TypedBaseItems`"))
+    rows = rows_with_negative_dates(tqdm(rows, total=rowcount) if rowcount > 100 else rows)
 
-    rowcount = len(rows)
     if parallel:
         with DisableLogger():
-            CHUNK_SIZE = 2000
-            rows_part = partition(rows, CHUNK_SIZE)
-            num_rows_part = math.ceil(rowcount / CHUNK_SIZE)
-            outs = []
             proc = partial(
                 update_file_date_proc, fs_path_replacements=fs_path_replacements, target_root=target_root)
             with Pool(initializer=pool_init_globals, initargs=(get_globals(),)) as mpool:
-                for rows in tqdm(rows_part, total=num_rows_part):
-                    out = mpool.map(proc, rows, chunksize=100)
-                    outs += out
-            outs = list(filter(None, outs))  # filter out the Nones
-        for rowid, new_date_created, new_date_modified in tqdm(outs, desc='Updating database'):
-            cur.execute("UPDATE `TypedBaseItems` SET `DateCreated` = ? WHERE `rowid` = ?",
-                        (new_date_created, rowid))
-            cur.execute("UPDATE `TypedBaseItems` SET `DateModified` = ? WHERE `rowid` = ?",
-                        (new_date_modified, rowid))
-
+                outs = list(mpool.imap_unordered(proc, rows, chunksize=100))
     else:
-        pbar = tqdm(rows, total=rowcount) if rowcount > 100 else rows
-        # t = perf_counter()
-
-        for rowid, target, date_created, date_modified in pbar:
-            if not target:
-                continue
-            # Determine file path as seen by this script (see fs_path_replacements for details)
-            # Code taken from get_target
-            target, idgaf1, idgaf2 = recursive_root_path_replacer(
-                target, to_replace=fs_path_replacements)
-            target = Path(target)  # type: ignore
-            if not target.is_absolute():
-                if target.is_relative_to("/"):
-                    # Otherwise the line below will make target relative to the _root_ of target_root
-                    # instead of relative to target_root.
-                    target = target.relative_to("/")
-                target = target_root / target
-            # End of code taken from get_target
-
-            if not target.exists():
-                logging.info(
-                    f"File doesn't seem to exist; can't update its dates in the database: {target}")
-                continue
-
-            try:
-                date_created_ns = jf_date_str_to_python_ns(date_created)
-            except Exception as e:
-                logging.error(f'{target}: date created error: {e}')
-                raise e
-            try:
-                date_modified_ns = jf_date_str_to_python_ns(date_modified)
-            except Exception as e:
-                logging.error(
-                    f'[{library_db_target_path}]{target} date modified error: {e}')
-                raise e
-
-            if date_created_ns >= 0 and date_modified_ns >= 0:
-                continue
-
-            filestats = os.stat(target)
-
-            if date_created_ns < 0:
-                new_date_created = get_datestr_from_python_time_ns(
-                    filestats.st_ctime_ns)
-                cur.execute("UPDATE `TypedBaseItems` SET `DateCreated` = ? WHERE `rowid` = ?",
-                            (new_date_created, rowid))
-            if date_modified_ns < 0:
-                new_date_modified = get_datestr_from_python_time_ns(
-                    filestats.st_mtime_ns)
-                cur.execute("UPDATE `TypedBaseItems` SET `DateModified` = ? WHERE `rowid` = ?",
-                            (new_date_modified, rowid))
-
-    con.commit()
+        outs = [update_file_date_proc(row, fs_path_replacements, target_root) for row in rows]
+    # filter out the Nones
+    updates = [(new_date_created, new_date_modified, rowid)
+               for rowid, new_date_created, new_date_modified in filter(None, outs)]
+
+    # None means the date doesn't need to be updated; COALESCE keeps the current one then.
+    logging.info(f"Updating the dates of {len(updates)} rows.")
+    cur.executemany("UPDATE `TypedBaseItems` SET `DateCreated` = COALESCE(?, `DateCreated`), "
+                    "`DateModified` = COALESCE(?, `DateModified`) WHERE `rowid` = ?", updates)
+    cur.execute("COMMIT")
+    con.close()
     logging.info("Done.")
 
 
@@ -1153,9 +1759,10 @@ def program_main():
     log_file_handle.setFormatter(log_formatter)
     root_logger.addHandler(log_file_handle)  # add the log file handler
     logging.info("Starting Jellyfin Database Migration")
+    clear_replacer_caches()
+    created_dirs.clear()
     # Parse the config file
-    with open(args.config) as f:
-        config = MigrationConfig.from_toml(f)
+    config = load_config(args.config)
     original_root = Path(config.windows.root)
     source_root = args.source
     target_root = args.target
@@ -1525,10 +2132,11 @@ def program_main():
         todo_list_id_paths,
         process_func=process_file,
         replace_func=recursive_id_path_replacer,
-        path_replacements={**path_replacements, **id_replacements_path},
+        # Same as {**path_replacements, **id_replacements_path} without copying both dicts.
+        path_replacements=ChainMap(id_replacements_path, path_replacements),
     )
     # Clean up empty folders that may be left behind in the target directory
-    # delete_empty_folders(target_root)
+    delete_empty_folders(target_root)
 
     # Replace remaining ids.
     logging.info("Processing remaining IDs")
@@ -1,15 +1,19 @@
 # %%
 from __future__ import annotations
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 import os
-from pathlib import Path
-from typing import Iterable, List, Optional, Tuple
+import stat
+from pathlib import Path, PurePosixPath
+from typing import Callable, Iterable, List, Optional, Tuple
 import logging
 from dataclasses import dataclass, field
 from fancy_dataclass import TOMLDataclass
 from tqdm import tqdm
 
 from .argparse_override import override
+from .config import load_cached_config
 # %% Define the configuration dataclass
 
 
@@ -52,7 +56,26 @@ root_logger.setLevel(logging.DEBUG)  # logger handles debug and up
 # %%
 
 
-def convert_from_unix(fname: str | List[str], root: Optional[str] = None) -> Tuple[str, Path] | None | List[Tuple[str, Path]]:
+def convert_path_from_unix(fname: str, root: Optional[str] = None) -> Tuple[str, PurePosixPath]:
+    """Convert a single UNIX path to a Windows path
+
+    Args:
+        fname (str): String from `find /path/to/files -links +1 2>/dev/null > /path/to/output.txt` command.
+        root (Optional[str], optional): Root path to make the path relative to. Defaults to None.
+
+    Returns:
+        Tuple[str, PurePosixPath]: Drive letter and sanitized Windows path.
+    """
+    if root is not None:
+        # make it relative to the root
+        fname = os.path.relpath(fname, root)
+    # the first part is the drive letter
+    drive, _, path = fname.partition('/')
+    # convert the rest to a (pure) path object (relative to the drive, even if there are several /)
+    return (drive, PurePosixPath(path.lstrip('/')))
+
+
+def convert_from_unix(fname: str | List[str], root: Optional[str] = None) -> Tuple[str, PurePosixPath] | None | List[Tuple[str, PurePosixPath]]:
     """Convert a UNIX path to a Windows path
 
     Args:
@@ -63,17 +86,10 @@ def convert_from_unix(fname: str | List[str], root: Optional[str] = None) -> Tup
         TypeError: Invalid input type.
 
     Returns:
-        Path | None | List[Path]: Sanitized Windows paths, if they exist.
+        Tuple[str, PurePosixPath] | None | List[Tuple[str, PurePosixPath]]: Sanitized Windows paths, if they exist.
     """
     if isinstance(fname, str):  # If string
-        if root is not None:
-            # make it relative to the root
-            fname = os.path.relpath(fname, root)
-        parts = fname.split('/')  # Split by UNIX line ending
-        drive = parts[0]  # the first part is the drive letter
-        path = os.path.join('', *parts[1:])  # join all the parts
-        path = Path(path)  # convert to a Path object
-        return (drive, path)
+        return convert_path_from_unix(fname, root)
     elif isinstance(fname, Iterable):
         out = [convert_from_unix(f) for f in fname]
         # filter out the invalid paths
@@ -82,7 +98,29 @@ def convert_from_unix(fname: str | List[str], root: Optional[str] = None) -> Tup
         raise TypeError(f'Unknown type {type(fname)}')
 
 
-def import_symlinks(fname: str, fakeroot: Optional[str] = None, realroot: Optional[str] = '/mnt') -> Tuple[List[Tuple[str, Path]], List[Tuple[str, Path]]]:
+def make_relpath(root: Optional[str]) -> Callable[[str], str]:
+    """## Build a function that makes paths relative to a fixed root.
+
+    ### Args:
+        - `root (Optional[str])`: Root path to make the paths relative to. Paths are returned unchanged if None.
+
+    ### Returns:
+        - `Callable[[str], str]`: Function equivalent to `os.path.relpath(path, root)`.
+    """
+    if root is None:
+        return lambda path: path
+    # Paths below the root only need the prefix cut off; everything else goes through relpath.
+    prefix = root.rstrip('/') + '/'
+    plen = len(prefix)
+
+    def relpath(path: str) -> str:
+        if path.startswith(prefix):
+            return path[plen:]
+        return os.path.relpath(path, root)
+    return relpath
+
+
+def import_symlinks(fname: str, fakeroot: Optional[str] = None, realroot: Optional[str] = '/mnt') -> Tuple[List[Tuple[str, PurePosixPath]], List[Tuple[str, PurePosixPath]]]:
     """## Import symlink descriptions from a file.
 
     ### Args:
@@ -91,85 +129,155 @@ def import_symlinks(fname: str, fakeroot: Optional[str] = None, realroot: Option
         - `realroot (Optional[str], optional)`: Root path to make the real path relative to. Defaults to '/mnt'.
 
     ### Returns:
-        - `Tuple[List[Tuple[str, Path]], List[Tuple[str, Path]]]`: Tuple of real and fake paths. Each path is a tuple of the drive letter and the path to the drive root. 
+        - `Tuple[List[Tuple[str, PurePosixPath]], List[Tuple[str, PurePosixPath]]]`: Tuple of real and fake paths. Each path is a tuple of the drive letter and the path to the drive root. 
     """
     logging.info(
         f"Importing symlinks from {fname} with fakeroot={fakeroot} and realroot={realroot}")
-    lines = open(fname, 'r').readlines()  # Read the file
-    lines = [line.rstrip() for line in lines]  # Remove trailing whitespace
     fakes = []  # List of fake paths
     reals = []  # List of real paths
-    for line in tqdm(lines, desc='Import symlinks'):  # Iterate over the lines
-        # Discard the first 10 words of size, permissions, etc.
-        line = line.split(maxsplit=10)[-1]
-        # Split the remaining line by the symlink arrow
-        words = line.split('->')
-        if len(words) == 2:  # If there are two parts
-            # The first part is the fake path
-            fake = words[0].strip().replace('\\', '')
-            # The second part is the real path
-            real = words[1].strip().replace('\\', '')
-            # Convert the fake path to a Windows path
-            fdr, fake = convert_from_unix(fake, root=fakeroot)  # type: ignore
-            # Convert the real path to a Windows path
-            rdr, real = convert_from_unix(real, root=realroot)  # type: ignore
-            fakes.append((fdr, fake))
-            reals.append((rdr, real))
-        else:
-            logging.warning(f"Invalid line: {line}")
+    # Read the file line by line. The progress bar is updated in batches of lines rather than
+    # for every single line.
+    batch = 4096
+    count = 0
+    rel_fake = make_relpath(fakeroot)
+    rel_real = make_relpath(realroot)
+    with open(fname, 'r', buffering=1 << 20) as f, tqdm(desc='Import symlinks', mininterval=0.5) as pbar:
+        for count, line in enumerate(f, 1):  # Iterate over the lines
+            if count % batch == 0:
+                pbar.update(batch)
+            line = line.rstrip()  # Remove trailing whitespace
+            # Discard the first 10 words of size, permissions, etc.
+            line = line.split(maxsplit=10)[-1]
+            # Split the remaining line by the symlink arrow
+            words = line.split('->')
+            if len(words) == 2:  # If there are two parts
+                # The first part is the fake path
+                fake = words[0].strip().replace('\\', '')
+                # The second part is the real path
+                real = words[1].strip().replace('\\', '')
+                # Convert the fake path to a Windows path
+                fdr, fake = convert_path_from_unix(rel_fake(fake))
+                # Convert the real path to a Windows path
+                rdr, real = convert_path_from_unix(rel_real(real))
+                fakes.append((fdr, fake))
+                reals.append((rdr, real))
+            else:
+                logging.warning(f"Invalid line: {line}")
+        pbar.update(count % batch)
     return reals, fakes
 
 
+@lru_cache(maxsize=8192)
+def dir_exists(path: str) -> bool:
+    """## Check whether a folder exists, remembering the result.
+
+    Many symlinks point into the same few folders, so their parents are only checked once.
+
+    ### Args:
+        - `path (str)`: Path to the folder.
+
+    ### Returns:
+        - `bool`: Whether the folder exists.
+    """
+    return os.path.isdir(path)
+
+
 def remap_symlink(
-        real: Tuple[str, Path],  # type: ignore
-        fake: Tuple[str, Path],  # type: ignore
+        real: Tuple[str, PurePosixPath],  # type: ignore
+        fake: Tuple[str, PurePosixPath],  # type: ignore
         drive_map: dict[str, Path],
         dry_run: bool = False,
-        overwrite: bool = False
+        overwrite: bool = False,
+        verify_target: bool = True
 ) -> None:
     """## Remap a windows symlink to a UNIX symlink.
 
     ### Args:
-        - `real (Tuple[str, Path])`: Real path to the symlink.
-        - `fake (Tuple[str, Path])`: Path to the symlink.
-        - `drive_map (dict[str, Path])`: Dictionary mapping drive letters to UNIX paths.
+        - `real (Tuple[str, PurePosixPath])`: Real path to the symlink.
+        - `fake (Tuple[str, PurePosixPath])`: Path to the symlink.
+        - `drive_map (dict[str, Path])`: Dictionary mapping (lower case) drive letters to UNIX paths.
         - `dry_run (bool, optional)`: Dry run. Defaults to False.
         - `overwrite (bool, optional)`: Actually remove the NTFS symlink. Defaults to False.
+        - `verify_target (bool, optional)`: Check that the real path exists. Defaults to True.
 
     ### Raises:
         - `ValueError`: Drive letter not in drive map.
-        - `FileNotFoundError`: Real path does not exist.
+        - `FileNotFoundError`: Real path does not exist (only checked with `verify_target`).
         - `FileExistsError`: Fake path already exists.
     """
     rdr, real = real
     fdr, fake = fake
     # Check if the drive letter is in the drive map
-    if rdr.lower() in drive_map:
-        # If it is, remap the path to the new drive letter
-        real = drive_map[rdr] / real
-    else:
+    drive_root = drive_map.get(rdr)
+    if drive_root is None:
         raise ValueError(f"Drive letter {rdr} not in drive map")
+    # If it is, remap the path to the new drive letter (only now as a Path to the file system)
+    real = Path(drive_root, real)
     # Check if the drive letter is in the drive map
-    if fdr.lower() in drive_map:
-        # If it is, remap the path to the new drive letter
-        fake = drive_map[fdr] / fake
-    else:
+    drive_root = drive_map.get(fdr)
+    if drive_root is None:
         raise ValueError(f"Drive letter {fdr} not in drive map")
+    # If it is, remap the path to the new drive letter
+    fake = Path(drive_root, fake)
     real: Path = real
     fake: Path = fake
     # Check if the real path exists
     if dry_run:
         logging.info(f"Symlink: {real} -> {fake}")
         return
-    if not real.exists():
-        raise FileNotFoundError(f"Real path {real} does not exist")
-    os.system(f'rm "{fake}"')
+    # Whether the real path is a folder only matters on Windows, so unless it's verified, the
+    # real path isn't touched at all on other systems.
+    target_is_directory = False
+    if verify_target or os.name == 'nt':
+        # Links into a missing folder (f. ex. an unmounted drive) don't need a stat of their own
+        if not dir_exists(os.fspath(real.parent)):
+            raise FileNotFoundError(f"Real path {real} does not exist")
+        # One stat for both, checking that it exists and whether it's a folder
+        try:
+            real_stat = os.stat(real)
+        except (OSError, ValueError):
+            raise FileNotFoundError(f"Real path {real} does not exist") from None
+        target_is_directory = stat.S_ISDIR(real_stat.st_mode)
+    # Links fixed by an earlier run are left alone
+    try:
+        if os.readlink(fake) == os.fspath(real):
+            logging.debug(f"Symlink {fake} already points to {real}")
+            return
+    except OSError:
+        pass
+    # Remove the NTFS symlink (anything but a folder, just like rm would)
+    if fake.is_symlink() or fake.exists() and not fake.is_dir():
+        fake.unlink()
     if fake.exists():
         if not overwrite:
             raise FileExistsError(f"Fake path {fake} already exists")
         else:
             logging.debug(f"Fake path {fake} already exists, overwriting")
-    os.system(f'ln -s "{real}" "{fake}"')
+    os.symlink(os.fspath(real), os.fspath(fake), target_is_directory=target_is_directory)
+
+def try_remap_symlink(
+        pair: Tuple[Tuple[str, PurePosixPath], Tuple[str, PurePosixPath]],
+        drive_map: dict[str, Path],
+        dry_run: bool = False,
+        overwrite: bool = False,
+        verify_target: bool = True
+) -> None:
+    """## Remap a symlink, logging errors instead of raising them.
+
+    ### Args:
+        - `pair (Tuple[Tuple[str, PurePosixPath], Tuple[str, PurePosixPath]])`: Real and fake path, see `remap_symlink`.
+        - `drive_map (dict[str, Path])`: Dictionary mapping drive letters to UNIX paths.
+        - `dry_run (bool, optional)`: Dry run. Defaults to False.
+        - `overwrite (bool, optional)`: Actually remove the NTFS symlink. Defaults to False.
+        - `verify_target (bool, optional)`: Check that the real path exists. Defaults to True.
+    """
+    real, fake = pair
+    try:
+        remap_symlink(real, fake, drive_map, dry_run=dry_run, overwrite=overwrite,
+                      verify_target=verify_target)
+    except Exception as e:
+        # Log the error without newlines
+        logging.warning(f"{e}".replace('\n', ' '))
 
 # %% Class to handle the generate command line argument
 
@@ -197,6 +305,10 @@ def symlink_fixer():
                         help='Path to the configuration TOML file')
     parser.add_argument('--execute',
                         help='Apply symlinks', default=False, action='store_true')
+    parser.add_argument('--verify-targets', default=False, action='store_true',
+                        help='Check that the target of every symlink exists before creating it')
+    parser.add_argument('--jobs', type=int, default=32,
+                        help='Number of symlinks to create in parallel')
     parser.add_argument('--debug', type=str,
                         help='Debug mode [DEBUG | INFO | WARNING | ERROR]', default='WARNING')
     parser.add_argument('--logfile', type=str,
@@ -228,21 +340,26 @@ def symlink_fixer():
         raise FileNotFoundError(f"Symlink file {args.symlinks} does not exist")
     if not os.path.exists(args.config):
         raise FileNotFoundError(f"Config file {args.config} does not exist")
-    # Load the configuration
-    with open(args.config, 'r') as f:
-        # Load the configuration from the TOML file
-        logging.info(f"Loading configuration from {args.config}")
-        config = SymlinkFixerConfig.from_toml(f)
+    # Load the configuration from the TOML file (or its cached copy)
+    logging.info(f"Loading configuration from {args.config}")
+    config = load_cached_config(args.config, SymlinkFixerConfig)
+    # The drive letters are looked up in lower case, like they appear in the WSL paths (/mnt/c)
+    config.mapping = {k.lower(): v for k, v in config.mapping.items()}
 
     reals, fakes = import_symlinks(
         args.symlinks, config.fakeroot, config.realroot)
 
-    for real, fake in tqdm(zip(reals, fakes), total=len(reals), desc='Creating symlinks'):
-        try:
-            remap_symlink(real, fake, config.mapping, dry_run=dry_run, overwrite=True)
-        except Exception as e:
-            # Log the error without newlines
-            logging.warning(f"{e}".replace('\n', ' '))
+    # Links into the same folder are handled one after another; their targets share the
+    # same directory entries (and cache) then.
+    pairs = sorted(zip(reals, fakes), key=lambda pair: (pair[0][0], os.fspath(pair[0][1].parent)))
+
+    # The work is mostly waiting for the file system, so the links are created by several
+    # threads at once.
+    remap = partial(try_remap_symlink, drive_map=config.mapping, dry_run=dry_run, overwrite=True,
+                    verify_target=args.verify_targets)
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        for _ in tqdm(executor.map(remap, pairs), total=len(pairs), desc='Creating symlinks'):
+            pass
 
 
 # %%